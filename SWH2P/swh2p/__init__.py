@@ -1,4 +1,4 @@
 from .core import TSeries, ZSeries, SingleImage
-from .core import index_tseries_single, index_tseries_all
+from .core import index_tseries_single, index_tseries_all, watch_tseries
 from .data_stuff import lowpass,convolve,kernel_gaussian
 __version__='0.0.1'
\ No newline at end of file
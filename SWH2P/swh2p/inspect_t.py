@@ -7,6 +7,9 @@ import numpy as np
 import matplotlib.image as mpimg
 import glob
 import os
+import concurrent.futures
+
+DECODE_WORKERS=min(8,os.cpu_count() or 1) # threads used to load TIF frames
 
 def xml_value_from_key(xml,match,matchNumber=1):
     """
@@ -62,11 +65,17 @@ def xml_parse_prairie(xmlFileName):
     print("XML parsing produced: %d time points"%len(times))
     return conf
 
-def inspect_folder(folder):
+def frame_read(fnames):
+    """return the image of every channel of a frame (a list of files)."""
+    return [mpimg.imread(x) for x in fnames]
+
+def inspect_folder(folder,workers=DECODE_WORKERS):
     """
     Given a 2P folder right off the 2P scope, load all the image data
     and it (as two numpy arrays) plus a dictionary of XML settings (i.e.,
     magnification, scan rate, laser settings, etc.)
+    Frames are decoded by a pool of worker threads (workers=1 loads them
+    one at a time without a pool).
 
     Returns [G,R,fnamesCH1,fnamesCH2,conf]
     """
@@ -89,10 +98,17 @@ def inspect_folder(folder):
         G,R=np.load(folder+"/data_G.npy"),np.load(folder+"/data_R.npy")
     else:
         R,G=np.empty((nFrames,sizeY,sizeX)),np.empty((nFrames,sizeY,sizeX))
-        for i,timePoint in enumerate(times):
-            print("loading frame %d of %d (%.02f%%)"%(i+1,len(times),(i+1)*100.0/len(times)))
-            R[i]=mpimg.imread(fnamesCH1[i])
-            G[i]=mpimg.imread(fnamesCH2[i])
+        # frames are decoded in a thread pool (and arrive in order)
+        fnames=list(zip(fnamesCH1[:nFrames],fnamesCH2[:nFrames]))
+        pool=concurrent.futures.ThreadPoolExecutor(workers) if workers>1 \
+             else None
+        loaded=pool.map(frame_read,fnames) if pool else map(frame_read,fnames)
+        for i,frames in enumerate(loaded):
+            print("loading frame %d of %d (%.02f%%)"%(i+1,nFrames,
+                  (i+1)*100.0/nFrames))
+            R[i],G[i]=frames
+        if pool:
+            pool.shutdown()
         print("saving data to disk...")
         np.save(folder+"/data_G.npy",G)
         np.save(folder+"/data_R.npy",R)
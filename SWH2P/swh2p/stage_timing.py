@@ -0,0 +1,101 @@
+"""
+Measure stages of an analysis (wall time, CPU time, peak memory, and bytes
+read) when the environment variable STAGE_TIMING=1 is set. Used by SWH2P
+and pyLS (which imports this file from its path), so it only needs the
+standard library.
+"""
+
+import os
+import sys
+import time
+import json
+import contextlib
+
+TIMING=os.environ.get("STAGE_TIMING","").lower() not in ['','0','false','no']
+_stages=[] # stages measured since the last timing_report()
+_stagesOpen=[] # names of stages currently running (they may be nested)
+
+def process_peak_memory():
+    """return the most memory (bytes of RSS) this process has used."""
+    try:
+        import resource
+        peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform=="darwin" else peak*1024
+    except:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset # Windows
+    except:
+        return None
+
+def process_bytes_read():
+    """
+    return how many bytes this process has read from files. This counts
+    read calls (even if the file was cached) but not memory-mapped pages.
+    """
+    try:
+        import psutil
+        counters=psutil.Process().io_counters()
+        return getattr(counters,'read_chars',counters.read_bytes)
+    except:
+        pass
+    try:
+        with open("/proc/self/io") as f:
+            return int(f.read().split("rchar:")[1].split()[0])
+    except:
+        return None
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    If TIMING, measure the code in this context (or function, if used as a
+    decorator) as a named stage: wall time, CPU time, peak RSS, and bytes
+    read. Stages may be nested. Work done by other processes isn't counted.
+    """
+    if not TIMING:
+        yield
+        return
+    _stagesOpen.append(name)
+    t1,c1,read1=time.perf_counter(),time.process_time(),process_bytes_read()
+    peak1=process_peak_memory()
+    try:
+        yield
+    finally:
+        _stagesOpen.pop()
+        read2,peak2=process_bytes_read(),process_peak_memory()
+        _stages.append({'stage':name,'depth':len(_stagesOpen),
+                        'started':t1,
+                        'parent':_stagesOpen[-1] if _stagesOpen else None,
+                        'seconds':time.perf_counter()-t1,
+                        'cpu':time.process_time()-c1,
+                        'peakRSS':peak2,
+                        'peakGrowth':None if peak1 is None else peak2-peak1,
+                        'bytesRead':None if read1 is None else read2-read1})
+
+def timing_report(saveAs=None,reset=True):
+    """
+    print a table of the stages measured (in the order they started) and
+    return them as a list of dictionaries ('started' is seconds after the
+    first stage). If saveAs is given, they are also saved there as JSON.
+    If reset, they are forgotten afterwards.
+    """
+    stages=sorted(_stages,key=lambda x:x['started'])
+    t0=stages[0]['started'] if stages else 0
+    stages=[dict(x,started=x['started']-t0) for x in stages]
+    def MB(val):
+        return "%9s"%"?" if val is None else "%9.01f"%(val/2**20)
+    print("%-40s %9s %9s %9s %9s %9s"%("stage","wall (s)","CPU (s)",
+                                       "peak (MB)","+peak","read (MB)"))
+    for x in stages:
+        print("%-40s %9.03f %9.03f %s %s %s"%(("  "*x['depth']+x['stage'])[:40],
+              x['seconds'],x['cpu'],MB(x['peakRSS']),MB(x['peakGrowth']),
+              MB(x['bytesRead'])))
+    if saveAs:
+        with open(saveAs,'w') as f:
+            json.dump({'created':time.strftime("%Y-%m-%d %H:%M:%S"),
+                       'pid':os.getpid(),'stages':stages},f,indent=1)
+        print("saved",saveAs)
+    if reset:
+        _stages.clear()
+    return stages
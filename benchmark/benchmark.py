@@ -0,0 +1,231 @@
+"""
+Time every stage of the analysis pipelines (SWH2P TSeries, pyLS LineScan,
+and ijp ROI) on synthetic data (see synthetic.py) at several scales and save
+the results as JSON so they can be compared against a previous run.
+
+    python benchmark.py --scales small medium --out results.json
+    python benchmark.py --compare results.json
+
+Synthetic data is created once (in the work folder) and reused. Every
+stage records wall time and CPU time. The injected calcium transients are
+compared to the analysis output too (as a correlation) so a change which
+makes things faster but wrong is noticed.
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+
+HERE=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,HERE)
+sys.path.insert(0,os.path.join(HERE,"../SWH2P"))
+sys.path.insert(0,os.path.join(HERE,"../pyLS"))
+sys.path.insert(0,os.path.join(HERE,"../ijp"))
+
+import matplotlib
+matplotlib.use('Agg')
+import synthetic
+
+# the size of the synthetic data for each scale
+SCALES={
+    'small':{'tseries':{'frames':100,'size':64,'cells':4},
+             'linescan':{'lines':500,'pixels':128,'frames':1},
+             'roi':{'rois':10,'frames':200}},
+    'medium':{'tseries':{'frames':500,'size':256,'cells':20},
+              'linescan':{'lines':1000,'pixels':255,'frames':5},
+              'roi':{'rois':50,'frames':1000}},
+    'large':{'tseries':{'frames':1000,'size':512,'cells':60},
+             'linescan':{'lines':4000,'pixels':255,'frames':20},
+             'roi':{'rois':200,'frames':5000}},
+}
+
+class Benchmark:
+    """collects the timing (and accuracy) of stages of each suite."""
+
+    def __init__(self,verbose=False):
+        self.verbose=verbose
+        self.results=[]
+
+    @contextlib.contextmanager
+    def stage(self,suite,scale,stage):
+        """time the code inside this context (output is hidden)."""
+        out=sys.stdout if self.verbose else io.StringIO()
+        t1,c1=time.perf_counter(),time.process_time()
+        with contextlib.redirect_stdout(out):
+            yield
+        result={'suite':suite,'scale':scale,'stage':stage,
+                'seconds':time.perf_counter()-t1,
+                'cpu':time.process_time()-c1}
+        self.results.append(result)
+        print("  %-10s %-8s %-16s %8.03f sec"%(suite,scale,stage,
+                                                result['seconds']))
+
+    def accuracy(self,suite,scale,correlation):
+        """record how well the output matched the injected transients."""
+        self.results.append({'suite':suite,'scale':scale,'stage':'accuracy',
+                             'correlation':float(correlation)})
+        print("  %-10s %-8s %-16s %8.03f r"%(suite,scale,'accuracy',
+                                              correlation))
+
+def correlation(measured,expected):
+    """return the (lowest, if 2D) correlation of measured and expected."""
+    measured,expected=np.atleast_2d(measured),np.atleast_2d(expected)
+    return min([np.corrcoef(x,y)[0,1] for x,y in zip(measured,expected)])
+
+def bench_tseries(bench,scale,folder,**kwargs):
+    import swh2p.core
+    if not os.path.exists(os.path.join(folder,"truth.json")):
+        synthetic.make_tseries(folder,**kwargs)
+    with open(os.path.join(folder,"truth.json")) as f:
+        truth=json.load(f)
+    folderSave=os.path.join(folder,"SWH2P")
+    if os.path.exists(folderSave):
+        shutil.rmtree(folderSave)
+    os.mkdir(folderSave)
+    xmlFile=os.path.join(folder,os.path.basename(folder)+".xml")
+    files=sorted(os.listdir(folder))
+    filesCH1=[os.path.join(folder,x) for x in files if '_Ch1_' in x]
+    filesCH2=[os.path.join(folder,x) for x in files if '_Ch2_' in x]
+
+    with bench.stage('TSeries',scale,'xml'):
+        swh2p.core.xml_parse_prairie(xmlFile)
+    with bench.stage('TSeries',scale,'ingest'):
+        stacks=swh2p.core.tseries_stacks(filesCH1,filesCH2,folderSave)
+    del stacks
+    with bench.stage('TSeries',scale,'load'):
+        TS=swh2p.core.TSeries(folder)
+    with bench.stage('TSeries',scale,'roi extraction'):
+        TS._roiAverages={}
+        for image3d in [TS.G,TS.R,TS.GoR]:
+            TS.roi_averages(image3d)
+    with bench.stage('TSeries',scale,'dGoR'):
+        TS.deltaGoverRs(method=1)
+        TS.deltaGoverRs(method=2)
+    with bench.stage('TSeries',scale,'report'):
+        TS.autoAnalyze(launch=False,rebuild=True,
+                       workers=swh2p.core.FIGURE_WORKERS)
+    with bench.stage('TSeries',scale,'report (again)'):
+        TS.autoAnalyze(launch=False,workers=swh2p.core.FIGURE_WORKERS)
+
+    times=np.arange(truth['frames'])*truth['framePeriod']
+    expected=[synthetic.transient(times,onset,amplitude,tauDecay=tau) \
+              for onset,amplitude,tau in zip(truth['onsets'],
+                                             truth['amplitudes'],truth['taus'])]
+    expected=dict(zip(truth['rois'],expected))
+    bench.accuracy('TSeries',scale,correlation(TS.dGoRs,
+        [expected[x] for x in TS.roisDict]))
+
+def bench_linescan(bench,scale,folder,**kwargs):
+    import pyLineScan
+    if not os.path.exists(os.path.join(folder,"truth.json")):
+        synthetic.make_linescan(folder,**kwargs)
+    with open(os.path.join(folder,"truth.json")) as f:
+        truth=json.load(f)
+
+    with bench.stage('LineScan',scale,'load'):
+        LS=pyLineScan.LineScan(folder)
+    with bench.stage('LineScan',scale,'report'):
+        LS.allFigures()
+
+    times=np.arange(truth['lines'])*truth['scanLinePeriod']
+    expected=[synthetic.transient(times,truth['onset'],amplitude,
+                                  tauRise=times[-1]/100,tauDecay=times[-1]/4) \
+              for amplitude in truth['amplitudes']]
+    bench.accuracy('LineScan',scale,correlation(
+        np.array(LS.dGoR.tolist()),expected))
+
+def bench_roi(bench,scale,folder,**kwargs):
+    import roi2p
+    csvFile=os.path.join(folder,"RoiSet.csv")
+    if not os.path.exists(csvFile):
+        os.makedirs(folder,exist_ok=True)
+        synthetic.make_roi_results(csvFile,**kwargs)
+    with open(os.path.splitext(csvFile)[0]+".json") as f:
+        truth=json.load(f)
+
+    with bench.stage('ROI',scale,'load'):
+        roi=roi2p.ROI(csvFile,truth['framePeriod'],truth['baseline'],
+                      truth['response'])
+    with bench.stage('ROI',scale,'report'):
+        roi.plotRoisMean(saveAs=os.path.join(folder,"dff-mean.png"))
+        roi.plotResponseScatter(saveAs=os.path.join(folder,"dff-responses.png"))
+        roi.plotHeatmap(saveAs=os.path.join(folder,"dff-heatmap.png"))
+        roi.saveCsv(os.path.join(folder,"dff.csv"))
+        matplotlib.pyplot.close('all')
+
+    times=np.arange(truth['frames'])*truth['framePeriod']
+    expected=[synthetic.transient(times,onset,amplitude,
+                                  tauDecay=times[-1]/10) \
+              for onset,amplitude in zip(truth['onsets'],truth['amplitudes'])]
+    bench.accuracy('ROI',scale,correlation(roi.dff.values.T,expected))
+
+SUITES={'TSeries':bench_tseries,'LineScan':bench_linescan,'ROI':bench_roi}
+
+def compare(results,baseline):
+    """print how long each stage took compared to a previous run."""
+    old={(x['suite'],x['scale'],x['stage']):x for x in baseline['results']}
+    print("\n%-10s %-8s %-16s %10s %10s %8s"%("suite","scale","stage",
+                                              "before","after","ratio"))
+    for result in results['results']:
+        key=(result['suite'],result['scale'],result['stage'])
+        if not key in old:
+            continue
+        field='correlation' if result['stage']=='accuracy' else 'seconds'
+        before,after=old[key][field],result[field]
+        print("%-10s %-8s %-16s %10.03f %10.03f %8.02f"%(key+(before,after,
+              after/before if before else np.nan)))
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--scales',nargs='+',default=['small','medium'],
+                        choices=list(SCALES))
+    parser.add_argument('--suites',nargs='+',default=list(SUITES),
+                        choices=list(SUITES))
+    parser.add_argument('--work',help='folder to hold the synthetic data',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             "swh2p-benchmark"))
+    parser.add_argument('--out',help='save results to this JSON file',
+                        default=os.path.join(HERE,"results.json"))
+    parser.add_argument('--compare',help='JSON results of a previous run')
+    parser.add_argument('--verbose',action='store_true',
+                        help='show the output of the code being timed')
+    args=parser.parse_args()
+
+    bench=Benchmark(args.verbose)
+    for scale in args.scales:
+        for suite in args.suites:
+            print("benchmarking %s (%s)"%(suite,scale))
+            folder=os.path.join(args.work,scale,{'TSeries':"TSeries-bench",
+                'LineScan':"LineScan-bench",'ROI':"ROI-bench"}[suite])
+            try:
+                SUITES[suite](bench,scale,folder,**SCALES[scale][suite.lower()])
+            except ImportError as e:
+                print("  skipping %s: %s"%(suite,e))
+            except Exception as e:
+                print("  %s FAILED: %s: %s"%(suite,type(e).__name__,e))
+                bench.results.append({'suite':suite,'scale':scale,
+                                      'stage':'failed','error':str(e)})
+
+    results={'date':time.strftime("%Y-%m-%d %H:%M:%S"),
+             'machine':platform.node(),'platform':platform.platform(),
+             'processor':platform.processor(),'cpus':os.cpu_count(),
+             'python':platform.python_version(),'numpy':np.__version__,
+             'scales':{x:SCALES[x] for x in args.scales},
+             'results':bench.results}
+    with open(args.out,'w') as f:
+        json.dump(results,f,indent=1)
+    print("saved",args.out)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results,json.load(f))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Quick checks that parts of the analysis give the right answer on small
+synthetic inputs (where the right answer is known). Every function named
+check_*() is run, and a failed check stops with an AssertionError.
+
+    python checks.py
+"""
+
+import os
+import sys
+import io
+import shutil
+import tempfile
+import contextlib
+import numpy as np
+
+HERE=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,HERE)
+sys.path.insert(0,os.path.join(HERE,"../SWH2P"))
+
+import matplotlib
+matplotlib.use('Agg')
+import swh2p.core
+import synthetic
+
+XML_OLD="""<?xml version="1.0" encoding="utf-8"?>
+<PVScan version="4.3.2.24" date="1/1/2013 12:00:00 PM" notes="">
+  <Sequence type="TSeries Timed Element" cycle="1">
+    <Frame relativeTime="0" absoluteTime="1.5" index="1" label="CurrentSettings">
+      <File channel="1" channelName="Ch1" filename="old_Cycle00001_Ch1_000001.tif" />
+      <File channel="2" channelName="Ch2" filename="old_Cycle00001_Ch2_000001.tif" />
+      <PVStateShard>
+        <Key key="objectiveLens" permissions="Read, Write, Save" value="40x" />
+        <Key key="pixelsPerLine" permissions="Read, Write, Save" value="64" />
+        <Key key="pmtGain_0" permissions="Read, Write, Save" value="650" />
+        <Key key="pmtGain_1" permissions="Read, Write, Save" value="825" />
+      </PVStateShard>
+    </Frame>
+  </Sequence>
+</PVScan>
+"""
+
+def check_xml_old_format():
+    """older XML gives each PMT its own key (pmtGain_0, pmtGain_1)."""
+    with tempfile.TemporaryDirectory() as folder:
+        fname=os.path.join(folder,"old.xml")
+        with open(fname,'w') as f:
+            f.write(XML_OLD)
+        conf=swh2p.core.xml_parse_prairie(fname,verbose=False)
+    assert conf['pmtGain1']==650, conf.get('pmtGain1')
+    assert conf['pmtGain2']==825, conf.get('pmtGain2')
+    assert conf['pixelsPerLine']==64
+    assert list(conf['framePmtGain2'])==[825]
+
+def blur2D_old(image2D,sigmaFrac=10):
+    """blur2D() as it was before image_blur() (a complex FFT per image)."""
+    ftimage = np.fft.fftshift(np.fft.fft2(image2D))
+    ncols, nrows = image2D.shape
+    cy, cx = nrows/2, ncols/2
+    sigmax,sigmay=ncols/sigmaFrac,nrows/sigmaFrac
+    x = np.linspace(0, nrows, nrows)
+    y = np.linspace(0, ncols, ncols)
+    X, Y = np.meshgrid(x, y)
+    gmask = np.exp(-(((X-cx)/sigmax)**2 + ((Y-cy)/sigmay)**2))
+    return np.abs(np.fft.ifft2(ftimage * gmask))
+
+def check_blur_agreement():
+    """
+    blur2D agrees with the old one within 2% of the image range at 64x64
+    and .25% at 256x256 (sigmaFrac=10). The old mask was on a grid spaced
+    n/(n-1) apart and centered half a frequency off, so the difference
+    shrinks with image size. The mean of the image is kept exactly.
+    """
+    rng=np.random.default_rng(0)
+    for size,tolerance in [(64,.02),(256,.0025)]:
+        Ys,Xs=np.mgrid[:size,:size]
+        for repeat in range(10):
+            image=rng.poisson(100,(size,size)).astype(float)
+            for Y,X in rng.uniform(0,size,(5,2)):
+                image+=300*np.exp(-((Ys-Y)**2+(Xs-X)**2)/(2*(size/20)**2))
+            blurred=swh2p.core.blur2D(image)
+            error=np.max(np.abs(blurred-blur2D_old(image)))/np.ptp(image)
+            assert error<tolerance, "%dx%d blur differs by %.02f%%"%(
+                size,size,error*100)
+            assert np.isclose(np.mean(blurred),np.mean(image))
+
+def check_registration_noisy():
+    """shifts of noisy (photon counting) frames are found exactly."""
+    rng=np.random.default_rng(0)
+    Ys,Xs=np.mgrid[:128,:128]
+    image=np.full((128,128),5.0)
+    for Y,X in rng.uniform(10,118,(12,2)):
+        image+=40*np.exp(-((Ys-Y)**2+(Xs-X)**2)/(2*3**2))
+    shifts=rng.integers(-6,7,(60,2))
+    shifts[:20]=0 # a still stack must stay still
+    frames=np.array([np.roll(image,tuple(x),axis=(0,1)) for x in shifts])
+    frames=rng.poisson(frames*.3).astype(np.float32)
+    found=swh2p.core.image_shifts(frames,swh2p.core.image_fft(image))
+    wrong=np.sum(np.any(found!=shifts,axis=1))
+    assert wrong==0, "%d of %d shifts are wrong"%(wrong,len(shifts))
+
+def check_rolling_percentile():
+    """
+    the sliding baseline is np.percentile of every (reflected) window, both
+    with scipy's rank filter and with the sorted window used without scipy.
+    """
+    rng=np.random.default_rng(0)
+    traces=np.cumsum(rng.normal(size=(3,500)),axis=1)
+    traces[1,::7]=traces[1,0] # repeated values
+    rolling_percentile_agrees(traces)
+    ndimage,swh2p.core.ndimage=swh2p.core.ndimage,None
+    try:
+        rolling_percentile_agrees(traces)
+    finally:
+        swh2p.core.ndimage=ndimage
+
+def rolling_percentile_agrees(traces):
+    """rolling_percentile() matches np.percentile of every window."""
+    for size in [1,2,25,100,999]:
+        for percentile in [0,20,37.5,50,100]:
+            found=swh2p.core.rolling_percentile(traces,size,percentile)
+            padded=np.pad(traces,((0,0),(size//2,size-1-size//2)),
+                          mode='reflect')
+            windows=np.lib.stride_tricks.sliding_window_view(padded,size,
+                                                             axis=1)
+            expected=np.percentile(windows,percentile,axis=2)
+            assert np.allclose(found,expected,rtol=0,atol=1e-12), \
+                "window %d, percentile %s, %s"%(size,percentile,
+                                                swh2p.core.ndimage)
+
+def check_decay_fit():
+    """
+    exp and biexp bleaching parameters are recovered from noisy traces,
+    fitting all frames or only the first half of them (see bleachFrames).
+    The fast component (20 sec of 1500 sec) is shorter than 1/50 of the
+    fitted span.
+    """
+    rng=np.random.default_rng(1)
+    times=np.arange(3000)*.5
+    for model,params in [('exp',[[100,50,-1/20,0,0],[80,60,-1/300,0,0]]),
+                         ('biexp',[[100,30,-1/20,40,-1/400]])]:
+        params=np.array(params,dtype=float)
+        curves=swh2p.core.decay_curve(params,times)
+        data=(curves+rng.normal(0,.05,curves.shape)).T
+        for frames in [None,np.arange(1500)]:
+            found=swh2p.core.decay_fit(data,times,frames,model)
+            assert np.allclose(found,params,rtol=.01,atol=.05), \
+                "%s fit of %s frames: %s"%(model,"all" if frames is None
+                                            else len(frames),found.tolist())
+
+def check_build_plan_unchanged():
+    """a TSeries loaded again (ROIs from their cache) plans no figures."""
+    folder=os.path.join(tempfile.mkdtemp(),"TSeries-check")
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            synthetic.make_tseries(folder,frames=40,size=64,cells=3)
+            TS=swh2p.core.TSeries(folder)
+            plan1=TS.build_plan()
+            TS.stacks_release()
+            TS=swh2p.core.TSeries(folder)
+            plan2=TS.build_plan()
+            TS.stacks_release()
+        changed=[x for x in plan2 if plan1.get(x)!=plan2[x]]
+        assert not changed, "would be made again: "+", ".join(changed)
+    finally:
+        shutil.rmtree(os.path.dirname(folder),ignore_errors=True)
+
+def main():
+    checks=[x for x in sorted(globals()) if x.startswith("check_")]
+    for name in checks:
+        globals()[name]()
+        print("passed",name)
+    print("all %d checks passed"%len(checks))
+
+if __name__=="__main__":
+    main()
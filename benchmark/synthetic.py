@@ -0,0 +1,286 @@
+"""
+Create synthetic PrairieView folders (TSeries and LineScan) which look like
+the real thing: an XML and .env file, 12-bit data in 16-bit Ch1 (red) and
+Ch2 (green) TIFs, a RoiSet.zip made with ImageJ's ROI manager (TSeries), and
+an experiment.txt with tags. Calcium transients of known timing and size are
+injected into the green channel so analysis results can be checked.
+
+Every folder gets a truth.json describing what was injected.
+"""
+
+import os
+import json
+import struct
+import zipfile
+import numpy as np
+from PIL import Image
+
+XML_HEADER="""<?xml version="1.0" encoding="utf-8"?>
+<PVScan version="5.3.64.400" date="1/1/2017 12:00:00 PM" notes="">
+  <PVStateShard>
+    <PVStateValue key="activeMode" value="Galvo" />
+    <PVStateValue key="bitDepth" value="12" />
+    <PVStateValue key="dwellTime" value="%(dwellTime)s" />
+    <PVStateValue key="framePeriod" value="%(framePeriod)s" />
+    <PVStateValue key="laserPower">
+      <IndexedValue index="0" value="5" description="Pockels" />
+    </PVStateValue>
+    <PVStateValue key="linesPerFrame" value="%(linesPerFrame)s" />
+    <PVStateValue key="objectiveLens" value="40x" />
+    <PVStateValue key="objectiveLensMag" value="40" />
+    <PVStateValue key="opticalZoom" value="4" />
+    <PVStateValue key="pixelsPerLine" value="%(pixelsPerLine)s" />
+    <PVStateValue key="pmtGain">
+      <IndexedValue index="0" value="650" description="Ch 1 HV" />
+      <IndexedValue index="1" value="825" description="Ch 2 HV" />
+    </PVStateValue>
+    <PVStateValue key="positionCurrent">
+      <SubindexedValues index="XAxis">
+        <SubindexedValue subindex="0" value="79" />
+      </SubindexedValues>
+      <SubindexedValues index="YAxis">
+        <SubindexedValue subindex="0" value="-1707.25" />
+      </SubindexedValues>
+      <SubindexedValues index="ZAxis">
+        <SubindexedValue subindex="0" value="301.77" />
+      </SubindexedValues>
+    </PVStateValue>
+    <PVStateValue key="scanLinePeriod" value="%(scanLinePeriod)s" />
+  </PVStateShard>
+  <Sequence type="%(sequenceType)s" cycle="1">
+"""
+
+XML_FRAME="""    <Frame relativeTime="%(relativeTime)s" absoluteTime="%(absoluteTime)s" index="%(index)d" parameterSet="CurrentSettings">
+      <File channel="1" channelName="Ch1" filename="%(fileCh1)s" />
+      <File channel="2" channelName="Ch2" filename="%(fileCh2)s" />
+      <PVStateShard />
+    </Frame>
+"""
+
+XML_FOOTER="""  </Sequence>
+</PVScan>"""
+
+ENV="""<?xml version="1.0" encoding="utf-8"?>
+<Environment>
+  <ConfigurationController />
+</Environment>"""
+
+def transient(times,onset,amplitude,tauRise=.5,tauDecay=5):
+    """return dF/F (fraction) of a calcium transient at the given times."""
+    t=np.clip(np.asarray(times,dtype=float)-onset,0,None)
+    return amplitude*(1-np.exp(-t/tauRise))*np.exp(-t/tauDecay)
+
+def clock(seconds):
+    """format seconds as M:SS (how times are written in experiment.txt)"""
+    seconds=int(round(seconds))
+    return "%d:%02d"%(seconds//60,seconds%60)
+
+def tif_save(fname,data):
+    """save a 2D array as a 16-bit TIF (values are clipped to 12 bits)."""
+    data=np.clip(np.round(data),0,4095).astype(np.uint16)
+    Image.fromarray(data).save(fname)
+
+def photons(rng,expected):
+    """add shot noise (gaussian approximation of poisson) to an image."""
+    return expected+rng.normal(size=expected.shape)*np.sqrt(expected)
+
+def roi_bytes(roiType,top,left,bottom,right,Xs=None,Ys=None):
+    """
+    return the bytes of an ImageJ .roi file. roiType may be 'rect', 'oval',
+    or 'polygon' (which needs the X and Y coordinates of every corner).
+    """
+    nCoordinates=0 if Xs is None else len(Xs)
+    header=bytearray(64)
+    header[0:4]=b'Iout'
+    struct.pack_into('>h',header,4,227) # version
+    header[6]={'polygon':0,'rect':1,'oval':2}[roiType]
+    struct.pack_into('>hhhhh',header,8,top,left,bottom,right,nCoordinates)
+    coordinates=b''
+    if nCoordinates:
+        coordinates=struct.pack('>%dh'%nCoordinates,*[x-left for x in Xs])+\
+                    struct.pack('>%dh'%nCoordinates,*[y-top for y in Ys])
+    struct.pack_into('>i',header,60,64+len(coordinates)) # header2 offset
+    return bytes(header)+coordinates+bytes(64)
+
+def cells_place(rng,nCells,size,radius):
+    """return (X,Y) centers of cells which don't touch each other."""
+    centers=[]
+    for attempt in range(nCells*1000):
+        if len(centers)==nCells:
+            break
+        X,Y=rng.uniform(radius*2,size-radius*2,2)
+        if all([np.hypot(X-x,Y-y)>radius*3 for x,y in centers]):
+            centers.append((X,Y))
+    return centers
+
+def make_tseries(folder,frames=200,size=128,cells=8,framePeriod=.5,
+                 roiTypes=('rect','oval','polygon'),seed=0):
+    """
+    Create a TSeries folder (its name should start with 'TSeries') holding
+    the given number of frames (size by size pixels) of cells whose green
+    fluorescence rises at a known time. experiment.txt has a baseline tag
+    (the first 20% of the recording) and a drug tag (40-60%), and every cell
+    responds during the drug tag. RoiSet.zip has an ROI around every cell,
+    drawn with roiTypes in turn. Returns the truth (also saved as truth.json).
+    """
+    rng=np.random.default_rng(seed)
+    os.makedirs(folder,exist_ok=True)
+    name=os.path.basename(os.path.abspath(folder))
+    times=np.arange(frames)*framePeriod
+    duration=frames*framePeriod
+    radius=max(3,size/40)
+
+    # cells are gaussian blobs in both channels
+    Ys,Xs=np.mgrid[:size,:size]
+    centers=cells_place(rng,cells,size,radius)
+    blobs=[np.exp(-((Xs-X)**2+(Ys-Y)**2)/(2*radius**2)) for X,Y in centers]
+    red=200+rng.uniform(-20,20,(size,size))+1500*np.sum(blobs,axis=0)
+    onsets=rng.uniform(.4,.5,len(centers))*duration
+    amplitudes=rng.uniform(.2,1,len(centers))
+    taus=rng.uniform(2,10,len(centers))
+    dffs=[transient(times,onset,amplitude,tauDecay=tau) for onset,amplitude,tau \
+          in zip(onsets,amplitudes,taus)]
+
+    # write one TIF per frame per channel
+    filesCh1,filesCh2=[],[]
+    for frame in range(frames):
+        green=100+1000*np.sum([blob*(1+dff[frame]) for blob,dff in \
+                              zip(blobs,dffs)],axis=0)
+        for channel,image,files in [[1,red,filesCh1],[2,green,filesCh2]]:
+            fname="%s_Cycle00001_Ch%d_%06d.ome.tif"%(name,channel,frame+1)
+            tif_save(os.path.join(folder,fname),photons(rng,image))
+            files.append(fname)
+
+    xml=XML_HEADER%{'dwellTime':7.2,'framePeriod':framePeriod,
+                    'linesPerFrame':size,'pixelsPerLine':size,
+                    'scanLinePeriod':framePeriod/size,
+                    'sequenceType':'TSeries Timed Element'}
+    for frame in range(frames):
+        xml+=XML_FRAME%{'relativeTime':times[frame],
+                        'absoluteTime':times[frame]+2.837,'index':frame+1,
+                        'fileCh1':filesCh1[frame],'fileCh2':filesCh2[frame]}
+    xml+=XML_FOOTER
+    with open(os.path.join(folder,name+".xml"),'w') as f:
+        f.write(xml)
+    with open(os.path.join(folder,name+".env"),'w') as f:
+        f.write(ENV)
+
+    # an ROI (drawn in ImageJ's ROI manager) around every cell
+    rois=[]
+    with zipfile.ZipFile(os.path.join(folder,"RoiSet.zip"),'w') as zf:
+        for i,(X,Y) in enumerate(centers):
+            roiType=roiTypes[i%len(roiTypes)]
+            r=int(np.ceil(radius*1.5))
+            top,left,bottom,right=int(Y)-r,int(X)-r,int(Y)+r+1,int(X)+r+1
+            Xs,Ys=None,None
+            if roiType=='polygon':
+                Xs=[int(X)-r,int(X),int(X)+r+1,int(X)]
+                Ys=[int(Y),int(Y)-r,int(Y),int(Y)+r+1]
+            roiName="%04d-%04d-%s"%(int(Y),int(X),roiType)
+            zf.writestr(roiName+".roi",roi_bytes(roiType,top,left,bottom,
+                                                 right,Xs,Ys))
+            rois.append(roiName)
+
+    tags={'baseline':[0,duration*.2],'drug':[duration*.4,duration*.6]}
+    with open(os.path.join(folder,"experiment.txt"),'w') as f:
+        for tag,(t1,t2) in tags.items():
+            f.write("%s=%s-%s\n"%(tag,clock(t1),clock(t2)))
+
+    truth={'type':'TSeries','frames':frames,'size':size,
+           'framePeriod':framePeriod,'tags':tags,'rois':rois,
+           'centers':centers,'onsets':onsets.tolist(),
+           'amplitudes':amplitudes.tolist(),'taus':taus.tolist()}
+    with open(os.path.join(folder,"truth.json"),'w') as f:
+        json.dump(truth,f,indent=1)
+    return truth
+
+def make_linescan(folder,lines=1000,pixels=255,frames=1,
+                  scanLinePeriod=.002,seed=0):
+    """
+    Create a LineScan folder (its name should start with 'LineScan') with
+    the given number of frames (repeated scans) of lines by pixels. A bright
+    structure (i.e., a dendrite) is crossed by the scan line, and its green
+    fluorescence rises at a known time (30% through the scan). Returns the
+    truth (also saved as truth.json).
+    """
+    rng=np.random.default_rng(seed)
+    os.makedirs(folder,exist_ok=True)
+    name=os.path.basename(os.path.abspath(folder))
+    times=np.arange(lines)*scanLinePeriod
+    duration=lines*scanLinePeriod
+    center=rng.uniform(.3,.7)*pixels
+    profile=np.exp(-(np.arange(pixels)-center)**2/(2*(pixels/30)**2))
+    onset=duration*.3
+    amplitudes=rng.uniform(.2,1,frames)
+
+    filesCh1,filesCh2=[],[]
+    for frame in range(frames):
+        dff=transient(times,onset,amplitudes[frame],tauRise=duration/100,
+                      tauDecay=duration/4)
+        red=np.tile(100+1500*profile,(lines,1))
+        green=50+500*np.outer(1+dff,profile)
+        for channel,image,files in [[1,red,filesCh1],[2,green,filesCh2]]:
+            fname="%s_Cycle%05d_Ch%d_000001.ome.tif"%(name,frame+1,channel)
+            tif_save(os.path.join(folder,fname),photons(rng,image))
+            files.append(fname)
+
+    xml=XML_HEADER%{'dwellTime':7.2,'framePeriod':duration,
+                    'linesPerFrame':lines,'pixelsPerLine':pixels,
+                    'scanLinePeriod':scanLinePeriod,'sequenceType':'Linescan'}
+    for frame in range(frames):
+        xml+=XML_FRAME%{'relativeTime':0,'absoluteTime':frame*duration,
+                        'index':1,'fileCh1':filesCh1[frame],
+                        'fileCh2':filesCh2[frame]}
+    xml+=XML_FOOTER
+    with open(os.path.join(folder,name+".xml"),'w') as f:
+        f.write(xml)
+    with open(os.path.join(folder,name+".env"),'w') as f:
+        f.write(ENV)
+
+    truth={'type':'LineScan','lines':lines,'pixels':pixels,'frames':frames,
+           'scanLinePeriod':scanLinePeriod,'center':center,'onset':onset,
+           'amplitudes':amplitudes.tolist()}
+    with open(os.path.join(folder,"truth.json"),'w') as f:
+        json.dump(truth,f,indent=1)
+    return truth
+
+def make_roi_results(fname,rois=20,frames=500,framePeriod=1,seed=0):
+    """
+    Create a CSV like the one ImageJ's ROI Multi-Measure tool saves (the
+    input of ijp/roi2p.py) with the mean intensity of every ROI by frame.
+    Every ROI responds 40-60% through the recording. Returns the truth (also
+    saved beside the CSV as .json).
+    """
+    rng=np.random.default_rng(seed)
+    times=np.arange(frames)*framePeriod
+    duration=frames*framePeriod
+    onsets=rng.uniform(.4,.5,rois)*duration
+    amplitudes=rng.uniform(.2,1,rois)
+    F0=rng.uniform(200,2000,rois)
+    columns=[]
+    for onset,amplitude,f0 in zip(onsets,amplitudes,F0):
+        dff=transient(times,onset,amplitude,tauDecay=duration/10)
+        columns.append(photons(rng,f0*(1+dff)))
+    data=np.column_stack([np.arange(1,frames+1)]+columns)
+    header=","+",".join(["Mean%d"%(x+1) for x in range(rois)])
+    np.savetxt(fname,data,delimiter=',',fmt='%.03f',header=header,comments='')
+    truth={'type':'ROI','rois':rois,'frames':frames,'framePeriod':framePeriod,
+           'baseline':[0,duration*.2],'response':[duration*.4,duration*.6],
+           'onsets':onsets.tolist(),'amplitudes':amplitudes.tolist()}
+    with open(os.path.splitext(fname)[0]+".json",'w') as f:
+        json.dump(truth,f,indent=1)
+    return truth
+
+if __name__=="__main__":
+    import argparse
+    parser=argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('folder',help='where to create the synthetic data')
+    parser.add_argument('--frames',type=int,default=200)
+    parser.add_argument('--size',type=int,default=128)
+    parser.add_argument('--cells',type=int,default=8)
+    args=parser.parse_args()
+    make_tseries(os.path.join(args.folder,"TSeries-synthetic"),
+                 args.frames,args.size,args.cells)
+    make_linescan(os.path.join(args.folder,"LineScan-synthetic"))
+    make_roi_results(os.path.join(args.folder,"RoiSet.csv"))
+    print("created synthetic data in",os.path.abspath(args.folder))
@@ -10,8 +10,13 @@ from PIL import Image
 from PIL import ImageEnhance
 import webbrowser
 import sys
+import time
+import json
+import contextlib
+import concurrent.futures
 
 ALPHA=.5
+DECODE_WORKERS=min(8,os.cpu_count() or 1) # threads used to load TIF frames
 DELTA=r'$\Delta$'
 
 COLORS=["b","g","orange","r","m"]
@@ -27,7 +32,13 @@ def COL2(frac):
     #return plt.cm.get_cmap('plasma')(frac)
     return plt.cm.get_cmap('jet')(1-frac)
 
+### STAGE TIMING (set the environment variable STAGE_TIMING=1 to use it)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "../SWH2P/swh2p"))
+from stage_timing import TIMING, stage, timing_report
+
 class LineScan:
+    @stage("LineScan load")
     def __init__(self,folder,verbose=False,baseline=None,marks=None,sigma=5,lock_scale=False):
         """
         The LineScan class provides an easy object to load and analyze data from PrairieView linescan folders.
@@ -101,6 +112,7 @@ class LineScan:
         try:return(float(s))
         except:return(s)
 
+    @stage("XML parse")
     def confLoad(self):
         """Load the content of the .env and .xml files to determine the parameters used to acquire the data."""
         keys=["dwellTime","scanLinePeriod","linesPerFrame","pixelsPerLine"]
@@ -123,19 +135,29 @@ class LineScan:
             self.baselineIs=[int(len(self.Xs)*.05),int(len(self.Xs)*.15)] # default to first 5-15% of the window
             self.baselineSec=[self.Xs[self.baselineIs[0]],self.Xs[self.baselineIs[1]]]
 
+    @stage("TIF decode")
     def dataLoad(self):
         """load TIF data as a 2d array and store it in the lists self.dataG and self.dataR"""
         self.dataR,self.dataG,self.dataGoR=[None]*self.frames,[None]*self.frames,[None]*self.frames
-        for frame in range(self.frames):
-            print("  loading frame %d of %d ..."%(frame+1,self.frames))
-            self.dataR[frame]=plt.imread(os.path.join(self.folder,self.filesR[frame]))
-            self.dataG[frame]=plt.imread(os.path.join(self.folder,self.filesG[frame]))
+
+        def loadFrame(frame):
+            """decode (and smooth) one frame of both channels. Runs in a worker thread."""
+            dataR=plt.imread(os.path.join(self.folder,self.filesR[frame]))
+            dataG=plt.imread(os.path.join(self.folder,self.filesG[frame]))
             if self.sigma>1:
                 # gaussian smoothing of image in the time domain
-                self.dataR[frame]=ndimage.gaussian_filter(self.dataR[frame],sigma=(self.sigma,0))
-                self.dataG[frame]=ndimage.gaussian_filter(self.dataG[frame],sigma=(self.sigma,0))
-            self.dataGoR[frame]=self.dataG[frame]/self.dataR[frame]
-
+                dataR=ndimage.gaussian_filter(dataR,sigma=(self.sigma,0))
+                dataG=ndimage.gaussian_filter(dataG,sigma=(self.sigma,0))
+            return dataR,dataG
+
+        # frames are decoded in parallel but collected in frame order
+        with concurrent.futures.ThreadPoolExecutor(max_workers=DECODE_WORKERS) as pool:
+            for frame,(dataR,dataG) in enumerate(pool.map(loadFrame,range(self.frames))):
+                print("  loaded frame %d of %d ..."%(frame+1,self.frames))
+                self.dataR[frame],self.dataG[frame]=dataR,dataG
+                self.dataGoR[frame]=self.dataG[frame]/self.dataR[frame]
+
+    @stage("traces and dG/R")
     def dataFlatten(self):
         """Flatten 2d data into 1d data. Creates traceG, traceR, and traceGoR."""
         self.traceG=np.array([None]*self.frames)
@@ -165,6 +187,7 @@ class LineScan:
             print("deleting",os.path.basename(fname),'...')
             os.remove(fname)
 
+    @stage("CSV write")
     def saveData(self,offset=2.46872):
         """generate CSV files of all data and save them in the analysis folder."""
         datadGoR=np.flipud(np.rot90(np.vstack((self.Xs+offset,np.array(self.dGoR.tolist())))))
@@ -427,15 +450,19 @@ class LineScan:
         self.clean()
         #self.refFig()
         self.saveData()
-        self.figureImg("fig_01_img.png")
-        self.figureAvg("fig_02_avg.png")
-        if self.frames<3: return
-        self.figureDriftRAW("fig_03_drift1.png")
-        self.figureDriftDGOR("fig_04_drift2.png")
-        self.figureDriftGOR("fig_05_drift3.png")
-        self.figureDriftGOR2("fig_05_drift32.png")
-        self.figure_dGoR_peak("fig_06_peak.png")
-        self.figure_dGoR_area("fig_07_area.png")
+        figures=[[self.figureImg,"fig_01_img.png"],[self.figureAvg,"fig_02_avg.png"]]
+        if self.frames>=3:
+            figures+=[[self.figureDriftRAW,"fig_03_drift1.png"],
+                      [self.figureDriftDGOR,"fig_04_drift2.png"],
+                      [self.figureDriftGOR,"fig_05_drift3.png"],
+                      [self.figureDriftGOR2,"fig_05_drift32.png"],
+                      [self.figure_dGoR_peak,"fig_06_peak.png"],
+                      [self.figure_dGoR_area,"fig_07_area.png"]]
+        for figure,saveAs in figures:
+            with stage("figure "+saveAs[:-4]):
+                figure(saveAs)
+        if TIMING:
+            timing_report(os.path.join(self.folderOut,"timing.json"))
 
     ### END OF FIGURES ####################
 